@@ -1,13 +1,24 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import logging
 import os
 import re
 import sys
 import signal
+import shlex
+import shutil
 import socket
 import subprocess
+import threading
+import traceback
+from collections import deque
 from pathlib import Path
-from typing import Optional, List, Dict, Any, Set
+from typing import Optional, List, Dict, Any, Set, Iterator, Callable
 
 
 try:
@@ -16,11 +27,51 @@ except Exception as e:
     print(f"FastMCP import failed: {e}", file=sys.stderr)
     sys.exit(1)
 
+# har2locust in-process entry point; the CLI subprocess is used when it is unavailable.
+try:
+    from har2locust.__main__ import __main__ as _h2l_main
+    from har2locust.argument_parser import get_parser as _h2l_parser
+except Exception:
+    _h2l_main = None
+    _h2l_parser = None
+
 mcp = FastMCP("mcp-locust") 
 
 # Helpers
 WORKDIR = Path.cwd()
-_PROCESS_REGISTRY: Dict[int, Dict[str, Any]] = {}  # pid -> {cmd,url,locustfile,mode}
+_WORKDIR_RESOLVED = WORKDIR.resolve()  # WORKDIR is fixed for the server's lifetime
+_WORKDIR_STR = str(_WORKDIR_RESOLVED)
+# pid -> {proc,command,url,locustfile,mode}
+_PROCESS_REGISTRY: Dict[int, Dict[str, Any]] = {}
+_STOP_TIMEOUT = 5.0  # seconds locust.stop waits after each signal before escalating
+# Guards sys.stdout/sys.path while har2locust runs in-process.
+_H2L_LOCK = threading.Lock()
+
+# Locustfile scanning: one pass over the source, dispatching on which branch matched.
+_TASK_OR_TAG_RX = re.compile(
+    r"(?P<task>@task(?:\s*\([^)]*\))?\s*\r?\n\s*def\s+(?P<task_name>[A-Za-z_]\w*)\s*\()"
+    r"|(?P<tag>@tag\s*\((?P<tag_args>[^)]*)\))"
+)
+_QUOTED_RX = re.compile(r"""(['"])(.*?)\1""")
+
+# Run with the target interpreter by locust.env_info; prints {dist: info} as JSON,
+# where info is the version, "" if importable without dist metadata, or null if
+# not importable at all.
+_VERSION_PROBE = """
+import importlib.metadata as m, importlib.util as u, json
+def v(dist):
+    try:
+        return m.version(dist)
+    except m.PackageNotFoundError:
+        return "" if u.find_spec(dist) else None
+print(json.dumps({d: v(d) for d in ("locust", "har2locust")}))
+"""
+
+# Directories never searched for locustfiles; hidden dirs such as .venv,
+# .locust_env and .git are skipped too.
+_SKIP_DIRS = frozenset(
+    {"__pycache__", "node_modules", "site-packages", "dist", "build"}
+)
 
 
 def _is_locustfile(p: Path) -> bool:
@@ -28,32 +79,58 @@ def _is_locustfile(p: Path) -> bool:
 
 
 def _under(base: Path, p: Path) -> bool:
+    base_str = _WORKDIR_STR if base == WORKDIR else str(base.resolve())
     try:
-        p.resolve().relative_to(base.resolve())
-        return True
+        p_str = str(p.resolve())
     except Exception:
         return False
+    return p_str == base_str or p_str.startswith(base_str.rstrip(os.sep) + os.sep)
+
+
+def _walk_py(root: Path) -> Iterator[os.DirEntry]:
+    # Breadth-first with each directory sorted by name, so the order is
+    # deterministic and shallower files are yielded first.
+    queue = deque([str(root)])
+    while queue:
+        try:
+            with os.scandir(queue.popleft()) as it:
+                entries = sorted(it, key=lambda e: e.name.lower())
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not name.startswith(".") and name not in _SKIP_DIRS:
+                    queue.append(entry.path)
+            elif name.lower().endswith(".py") and entry.is_file():
+                yield entry
+
+
+def _iter_locustfiles(workdir: Path = WORKDIR) -> Iterator[Path]:
+    return (Path(e.path) for e in _walk_py(workdir) if "locustfile" in e.name.lower())
 
 
 def _find_first_locustfile(workdir: Path = WORKDIR) -> Optional[Path]:
-    return next((p for p in workdir.rglob("*locustfile*.py") if _is_locustfile(p)), None)
+    return next(_iter_locustfiles(workdir), None)
 
 
 def _find_all_locustfiles(workdir: Path = WORKDIR) -> List[Path]:
-    def depth(p: Path) -> int:
-        return len(p.relative_to(workdir).parts)
-    files = [p for p in workdir.rglob("*locustfile*.py") if _is_locustfile(p)]
-    return sorted(files, key=lambda p: (depth(p), p.name.lower()))
+    # Walk order is already by depth, then by name within each directory; keeping it
+    # means the first entry is always what _find_first_locustfile returns.
+    return list(_iter_locustfiles(workdir))
+
+
+def _preferred_locustfile(preferred: Optional[str | Path]) -> Optional[Path]:
+    if not preferred:
+        return None
+    p = Path(preferred)
+    if not p.is_absolute():
+        p = (WORKDIR / p).resolve()
+    return p if _under(WORKDIR, p) and _is_locustfile(p) else None
 
 
 def _resolve_locustfile(preferred: Optional[str | Path] = None) -> Path:
-    if preferred:
-        p = Path(preferred)
-        if not p.is_absolute():
-            p = (WORKDIR / p).resolve()
-        if _under(WORKDIR, p) and _is_locustfile(p):
-            return p
-    found = _find_first_locustfile(WORKDIR)
+    found = _preferred_locustfile(preferred) or _find_first_locustfile(WORKDIR)
     if not found:
         raise FileNotFoundError("No locustfile found under workspace.")
     return found
@@ -76,45 +153,121 @@ def _ensure_file(path: Optional[str], fallback: Optional[Path] = None) -> Path:
     return p
 
 
+def _run_har2locust_inprocess(
+    h2l_main: Callable[[List[str]], None], har: Path, args: List[str]
+) -> str:
+    buf = io.StringIO()
+    log = io.StringIO()
+    # har2locust logs through the root logger; keep what it says for the error message.
+    handler = logging.StreamHandler(log)
+    root = logging.getLogger()
+    with _H2L_LOCK:
+        saved_path = list(sys.path)  # har2locust appends os.curdir on every run
+        root.addHandler(handler)
+        try:
+            with contextlib.redirect_stdout(buf):
+                h2l_main([*args, str(har)])
+        except (Exception, SystemExit) as e:
+            detail = log.getvalue() + traceback.format_exc()
+            raise RuntimeError(f"har2locust failed: {detail}") from e
+        finally:
+            root.removeHandler(handler)
+            sys.path[:] = saved_path
+    return buf.getvalue()
+
+
+def _utf8_env() -> Dict[str, str]:
+    # Built per call so children see the live environment (PATH, HAR2LOCUST_*, ...).
+    return {**os.environ, "PYTHONIOENCODING": "utf-8"}
+
+
+def _h2l_in_process_ok(har: Path, args: List[str]) -> bool:
+    if _h2l_parser is None:
+        return False
+    # Effective options, including har2locust.conf, pyproject.toml and
+    # HAR2LOCUST_* env vars, not just what is in argv.
+    try:
+        opts = _h2l_parser().parse_args([*args, str(har)])
+    except (Exception, SystemExit):
+        return False  # let the subprocess report the error
+    # Plugins register themselves globally on import, and the server has already
+    # configured logging, so only default-plugin runs at the server's log level
+    # are executed in-process.
+    level = logging.getLevelName(str(opts.loglevel).upper())
+    return (
+        not opts.plugins
+        and not opts.disable_plugins
+        and level == logging.getLogger().getEffectiveLevel()
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _har2locust_script() -> Optional[str]:
+    return shutil.which("har2locust")
+
+
 def _run_har2locust(python_cmd: Optional[str], cwd: Path, har: Path, args: List[str]) -> str:
     interpreter = python_cmd or sys.executable
-    cmd = [interpreter, "-m", "har2locust", *args, str(har)]
+    in_process = (
+        interpreter == sys.executable
+        and cwd == WORKDIR
+        and _h2l_in_process_ok(har, args)
+    )
+    if in_process and _h2l_main is not None:
+        return _run_har2locust_inprocess(_h2l_main, har, args)
+    script = None
+    if _h2l_main is None and interpreter == sys.executable:
+        script = _har2locust_script()
+    if script:
+        # This interpreter cannot import har2locust, so "-m har2locust" would only fail.
+        cmd = [script, *args, str(har)]
+    else:
+        cmd = [interpreter, "-m", "har2locust", *args, str(har)]
     try:
-        p = subprocess.run(cmd, cwd=str(cwd), check=True, capture_output=True, text=True)
-        return p.stdout
+        # Capture bytes and decode once. The child is told to write UTF-8 (Windows
+        # pipes default to the locale codepage) and CRLF is normalised to match
+        # the in-process path.
+        p = subprocess.run(
+            cmd, cwd=str(cwd), env=_utf8_env(), check=True, capture_output=True
+        )
+        return p.stdout.decode("utf-8").replace("\r\n", "\n")
     except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"har2locust failed: {e.stderr or e.stdout or e}") from e
+        detail = (e.stderr or e.stdout or b"").decode("utf-8", errors="replace")
+        raise RuntimeError(f"har2locust failed: {detail or e}") from e
 
 
 def _parse_tasks_and_tags(source: str) -> Dict[str, Any]:
-    tasks: List[str] = []
+    tasks: Set[str] = set()
     tags: Set[str] = set()
-    task_rx = re.compile(r"@task(?:\s*\([^)]*\))?\s*\r?\n\s*def\s+([A-Za-z_]\w*)\s*\(", re.MULTILINE)
-    tasks.extend(task_rx.findall(source))
-    tag_line_rx = re.compile(r"@tag\s*\(([^)]*)\)")
-    for m in tag_line_rx.finditer(source):
-        inner = m.group(1)
-        for t in re.findall(r"""(['"])(.*?)\1""", inner):
-            if t[1].strip():
-                tags.add(t[1].strip())
-    return {"tasks": sorted(set(tasks)), "tags": sorted(tags)}
-
-
-def _free_tcp_port(start: int = 8089, max_tries: int = 50) -> int:
-    port = start
-    for _ in range(max_tries):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            try:
-                s.bind(("127.0.0.1", port))
-                return port
-            except OSError:
-                port += 1
-    raise RuntimeError("No free TCP port found for Locust UI.")
+    for m in _TASK_OR_TAG_RX.finditer(source):
+        if m.lastgroup == "task":
+            tasks.add(m.group("task_name"))
+        else:
+            tags.update(t.strip() for _, t in _QUOTED_RX.findall(m.group("tag_args")))
+    tags.discard("")
+    return {"tasks": sorted(tasks), "tags": sorted(tags)}
+
+
+def _free_tcp_port(start: int = 8089) -> int:
+    # Prefer the conventional Locust port, otherwise let the kernel pick one.
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("127.0.0.1", start))
+        except OSError:
+            s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
 
+def _signal_process(pid: int, sig: int, group: bool) -> None:
+    if group and hasattr(os, "killpg"):
+        os.killpg(pid, sig)  # started with start_new_session, so the pgid is the pid
+    else:
+        os.kill(pid, sig)
 
-def _record_process(pid: int, info: Dict[str, Any]) -> None:
-    _PROCESS_REGISTRY[pid] = info
+
+def _record_process(proc: subprocess.Popen, info: Dict[str, Any]) -> None:
+    _PROCESS_REGISTRY[proc.pid] = {**info, "proc": proc}
 
 
 # Tools: discovery & info
@@ -127,12 +280,10 @@ def locust_find(preferred_path: Optional[str] = None) -> dict:
         "all": ["<match1>", "<match2>", ...]
       }
     """
-    all_matches = [str(p) for p in _find_all_locustfiles(WORKDIR)]
-    try:
-        best = str(_resolve_locustfile(preferred_path)) if all_matches else ""
-    except FileNotFoundError:
-        best = ""
-    return {"file": best, "all": all_matches}
+    matches = _find_all_locustfiles(WORKDIR)
+    # Reuse the single walk; matches[0] is what _resolve_locustfile would pick.
+    best = (_preferred_locustfile(preferred_path) or matches[0]) if matches else None
+    return {"file": str(best) if best else "", "all": [str(p) for p in matches]}
 
 
 @mcp.tool(name="locust.env_info", description="Return interpreter and tool versions for diagnostics.")
@@ -144,11 +295,29 @@ def locust_env_info(python_cmd: Optional[str] = None) -> dict:
             return (p.stdout or p.stderr or "").strip()
         except Exception as e:
             return f"unavailable ({e})"
+    # One interpreter start for both versions; dist metadata avoids importing the tools.
+    try:
+        p = subprocess.run(
+            [interpreter, "-c", _VERSION_PROBE],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        versions: Dict[str, Optional[str]] = json.loads(p.stdout)
+    except Exception:
+        # The probe itself failed (e.g. bad interpreter); let the CLIs report why.
+        versions = {"locust": "", "har2locust": ""}
+    def _resolve(mod: str) -> str:
+        found = versions.get(mod)
+        if found is None:
+            return "not installed"
+        # No dist metadata (source checkout, vendored copy): ask the CLI instead.
+        return found or _version(mod)
     return {
         "python": interpreter,
-        "locust": _version("locust"),
-        "har2locust": _version("har2locust"),
-        "cwd": str(WORKDIR),
+        "locust": _resolve("locust"),
+        "har2locust": _resolve("har2locust"),
+        "cwd": _WORKDIR_STR,
     }
 
 
@@ -176,9 +345,9 @@ def har_to_locust(
     Returns:
       { "path": "<written path or ''>", "code": "<generated source>" }
     """
-    har = Path(har_path)
-    if not har.is_absolute():
-        har = (WORKDIR / har).resolve()
+    # abspath is a pure string normalization; symlinks need not be resolved for reading.
+    har_str = os.path.join(_WORKDIR_STR, os.path.expanduser(har_path))
+    har = Path(os.path.abspath(har_str))
     if not har.exists():
         raise ValueError(f"HAR file not found: {har_path}")
 
@@ -199,7 +368,7 @@ def har_to_locust(
         if not out.is_absolute():
             out = (WORKDIR / out).resolve()
         out.parent.mkdir(parents=True, exist_ok=True)
-        out.write_text(code, encoding="utf-8")
+        out.write_bytes(code.encode("utf-8"))
         return {"path": str(out), "code": code}
 
 
@@ -224,13 +393,24 @@ def locust_run_ui(
         cmd += ["--host", host]
 
 
-    proc = subprocess.Popen(cmd, cwd=str(WORKDIR), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    _record_process(proc.pid, {"mode": "ui", "url": url, "command": " ".join(cmd), "locustfile": str(lf)})
-    return {"pid": proc.pid, "url": url, "command": " ".join(cmd)}
+    cmd_str = shlex.join(cmd)
+    # Own session/process group, so locust.stop can signal the UI and its workers.
+    proc = subprocess.Popen(
+        cmd,
+        cwd=_WORKDIR_STR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        start_new_session=True,
+    )
+    _record_process(
+        proc, {"mode": "ui", "url": url, "command": cmd_str, "locustfile": str(lf)}
+    )
+    return {"pid": proc.pid, "url": url, "command": cmd_str}
 
 
 @mcp.tool(name="locust.run_headless", description="Run Locust one-shot in headless mode; returns stdout/stderr.")
-def locust_run_headless(
+async def locust_run_headless(
     locustfile_path: Optional[str] = None,
     host: Optional[str] = None,
     users: int = 10,
@@ -253,35 +433,72 @@ def locust_run_headless(
     if tags:  cmd += ["--tags", tags]
     if tasks: cmd += ["--tasks", tasks]  # expects qualified names
 
+    cmd_str = shlex.join(cmd)
+    # Await the run so the server keeps serving other tools while Locust is running.
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=_WORKDIR_STR,
+        env=_utf8_env(),  # so non-ASCII names decode correctly on Windows too
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
     try:
-        p = subprocess.run(cmd, cwd=str(WORKDIR), check=True, capture_output=True, text=True)
-        return {"ok": True, "command": " ".join(cmd), "stdout": p.stdout, "stderr": p.stderr}
-    except subprocess.CalledProcessError as e:
-        return {"ok": False, "command": " ".join(cmd), "stdout": e.stdout, "stderr": e.stderr or str(e)}
+        out, err = await proc.communicate()
+    except asyncio.CancelledError:
+        # The run is not in the registry, so nothing else could stop it later.
+        with contextlib.suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+        raise
+    stdout = out.decode("utf-8", errors="replace")
+    stderr = err.decode("utf-8", errors="replace")
+    if proc.returncode:
+        stderr = stderr or f"Locust exited with status {proc.returncode}"
+        return {"ok": False, "command": cmd_str, "stdout": stdout, "stderr": stderr}
+    return {"ok": True, "command": cmd_str, "stdout": stdout, "stderr": stderr}
 
 
 @mcp.tool(name="locust.stop", description="Stop a running Locust process by PID.")
-def locust_stop(pid: int) -> dict:
+async def locust_stop(pid: int) -> dict:
+    info = _PROCESS_REGISTRY.get(pid)
+    proc: Optional[subprocess.Popen] = info["proc"] if info else None
+    # Only processes we started lead their own group; never signal a foreign group.
+    group = proc is not None
     try:
-        os.kill(pid, signal.SIGINT)
+        _signal_process(pid, signal.SIGINT, group)
     except Exception:
         try:
-            os.kill(pid, signal.SIGTERM)
+            _signal_process(pid, signal.SIGTERM, group)
         except Exception:
             return {"stopped": False}
     _PROCESS_REGISTRY.pop(pid, None)
+    if proc is not None:
+        # Wait in a thread so the event loop keeps serving other tools meanwhile.
+        try:
+            await asyncio.to_thread(proc.wait, _STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            with contextlib.suppress(Exception):
+                _signal_process(pid, signal.SIGTERM, group)
+            try:
+                await asyncio.to_thread(proc.wait, _STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                # SIGKILL the whole group so no worker is orphaned holding the web port.
+                with contextlib.suppress(ProcessLookupError):
+                    if hasattr(os, "killpg"):
+                        _signal_process(pid, signal.SIGKILL, group)
+                    else:
+                        proc.kill()
+                await asyncio.to_thread(proc.wait)
     return {"stopped": True}
 
+
 @mcp.tool(name="locust.ps", description="List processes started by this MCP.")
 def locust_ps() -> dict:
     procs = []
-    for pid, meta in list(_PROCESS_REGISTRY.items()):
-        # if still exists
-        alive = True
-        try:
-            os.kill(pid, 0)
-        except Exception:
-            alive = False
+    for pid, info in list(_PROCESS_REGISTRY.items()):
+        # poll() reaps the child once it has exited, so no zombie is left behind
+        alive = info["proc"].poll() is None
+        meta = {k: v for k, v in info.items() if k != "proc"}
         procs.append({"pid": pid, "alive": alive, **meta})
         if not alive:
             _PROCESS_REGISTRY.pop(pid, None)